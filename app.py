@@ -8,16 +8,27 @@ import logging
 import traceback 
 from datetime import datetime, timedelta
 import requests
+import schedule
 import urllib3
 import json
 import smtplib
 import io 
+import time
+import hashlib
+import hmac
+import queue
+import select
+import threading
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from email.mime.application import MIMEApplication
-from flask import Flask, request, render_template, session, redirect, url_for, jsonify, render_template_string, make_response
+import click
+from flask import Flask, Response, has_request_context, request, render_template, session, redirect, url_for, jsonify, render_template_string, make_response
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import or_, and_, func
+from flask_sqlalchemy.session import Session as SessaoFlask
+from flask_compress import Compress
+from sqlalchemy import or_, and_, func, text, event, insert, case, inspect, literal, tuple_, Insert, Update, Delete
+from sqlalchemy.pool import NullPool
 from slack_bolt import App as BoltApp
 from slack_bolt.adapter.flask import SlackRequestHandler
 
@@ -37,7 +48,81 @@ app.secret_key = os.environ.get("SECRET_KEY", "chave_padrao_segura")
 # Banco de Dados
 app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL')
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-db = SQLAlchemy(app)
+# Réplica de leitura opcional: GETs vão para ela, exceto logo após um commit do mesmo usuário
+DATABASE_REPLICA_URL = os.environ.get('DATABASE_REPLICA_URL')
+REPLICA_STICKY_SECONDS = int(os.environ.get('REPLICA_STICKY_SECONDS', 10))
+# PgBouncer em pool_mode=transaction: o pool fica no PgBouncer e o LISTEN do SSE
+# precisa de uma conexão direta ao Postgres (DATABASE_LISTEN_URL)
+DB_PGBOUNCER = os.environ.get('DB_PGBOUNCER', '0') == '1'
+DATABASE_LISTEN_URL = os.environ.get('DATABASE_LISTEN_URL')
+
+def opcoes_engine(prefixo):
+    # Pool por worker (dimensionamento documentado no gunicorn.conf.py).
+    # prefixo 'DB' = primário, 'DB_REPLICA' = réplica (herda do primário o que não for definido)
+    def cfg(nome, padrao):
+        return os.environ.get(f"{prefixo}_{nome}", os.environ.get(f"DB_{nome}", padrao))
+    if DB_PGBOUNCER:
+        # statement_timeout neste modo: query_timeout do PgBouncer ou ALTER ROLE ... SET
+        return {'poolclass': NullPool}
+    opcoes = {
+        'pool_size': int(cfg('POOL_SIZE', 10)),
+        'max_overflow': int(cfg('MAX_OVERFLOW', 10)),
+        'pool_timeout': int(cfg('POOL_TIMEOUT', 30)),
+        'pool_recycle': int(cfg('POOL_RECYCLE', 1800)),
+        'pool_pre_ping': cfg('POOL_PRE_PING', '1') == '1',
+    }
+    statement_timeout = int(cfg('STATEMENT_TIMEOUT_MS', 0))
+    if statement_timeout:
+        opcoes['connect_args'] = {'options': f"-c statement_timeout={statement_timeout}"}
+    return opcoes
+
+if (app.config['SQLALCHEMY_DATABASE_URI'] or '').startswith('postgres'):
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = opcoes_engine('DB')
+if DATABASE_REPLICA_URL:
+    app.config['SQLALCHEMY_BINDS'] = {'replica': {'url': DATABASE_REPLICA_URL, **opcoes_engine('DB_REPLICA')}}
+
+class SessaoRoteada(SessaoFlask):
+    # Leituras de requisições GET/HEAD vão para a réplica; escritas, flushes e
+    # usuários que gravaram há menos de REPLICA_STICKY_SECONDS ficam no primário.
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and self._usar_replica(clause):
+            return self._db.engines['replica']
+        return super().get_bind(mapper, clause=clause, bind=bind, **kwargs)
+
+    def _usar_replica(self, clause):
+        if not DATABASE_REPLICA_URL or not has_request_context(): return False
+        if self._flushing or isinstance(clause, (Insert, Update, Delete)):
+            self.info['gravou'] = True
+            return False
+        if self.info.get('gravou') or request.method not in ('GET', 'HEAD'): return False
+        return session.get('primario_ate', 0) < time.time()
+
+db = SQLAlchemy(app, session_options={'class_': SessaoRoteada})
+
+@event.listens_for(db.session, 'after_commit')
+def fixar_leituras_no_primario(sess):
+    # Read-your-writes: após gravar, o usuário lê do primário até a réplica alcançar
+    if sess.info.pop('gravou', False) and DATABASE_REPLICA_URL and has_request_context():
+        session['primario_ate'] = time.time() + REPLICA_STICKY_SECONDS
+
+# Compressão (gzip/brotli) de HTML e JSON
+app.config['COMPRESS_MIMETYPES'] = ['text/html', 'application/json']
+app.config['COMPRESS_ALGORITHM'] = ['br', 'gzip']
+app.config['COMPRESS_STREAMS'] = False
+Compress(app)
+
+# Cache do dashboard: os fragmentos ficam válidos enquanto a versão dos dados não
+# mudar. O TTL cobre alterações feitas fora do app (ex.: direto no Directus).
+DASHBOARD_CACHE_TTL = int(os.environ.get("DASHBOARD_CACHE_TTL", 300))
+_cache_dashboard = {}
+_cache_relatorio = {}
+
+# Eventos em tempo real (SSE): cada dashboard aberto tem uma fila neste worker.
+# No Postgres os eventos passam por LISTEN/NOTIFY e chegam a todos os workers.
+CANAL_EVENTOS = 'elostock_eventos'
+_assinantes_eventos = set()
+_ouvinte_eventos = None
+_lock_ouvinte = threading.Lock()
 
 # Variáveis Externas
 DIRECTUS_URL = os.environ.get("DIRECTUS_URL")
@@ -48,7 +133,17 @@ CNPJA_TOKEN = os.environ.get("CNPJA_TOKEN")
 
 # --- CONFIGURAÇÃO AUTENTIQUE ---
 AUTENTIQUE_TOKEN = os.environ.get("AUTENTIQUE_TOKEN")
-AUTENTIQUE_URL = "https://api.autentique.com.br/v2/graphql"
+# Para testar localmente a reconciliação: scripts/autentique_stub.py (uso no cabeçalho do script)
+AUTENTIQUE_URL = os.environ.get("AUTENTIQUE_URL", "https://api.autentique.com.br/v2/graphql")
+# Segredo do webhook (HMAC-SHA256 do corpo, enviado no header X-Autentique-Signature)
+AUTENTIQUE_WEBHOOK_SECRET = os.environ.get("AUTENTIQUE_WEBHOOK_SECRET")
+# Documentos consultados por chamada GraphQL na reconciliação
+AUTENTIQUE_LOTE = int(os.environ.get("AUTENTIQUE_LOTE", 25))
+
+# Timeout (segundos) das chamadas HTTP externas, para uma API lenta não prender o worker
+HTTP_TIMEOUT = int(os.environ.get("HTTP_TIMEOUT", 15))
+# Upload do PDF para o Autentique é mais lento que as demais chamadas
+AUTENTIQUE_UPLOAD_TIMEOUT = int(os.environ.get("AUTENTIQUE_UPLOAD_TIMEOUT", 60))
 
 # Configuração de E-mail (SMTP)
 SMTP_SERVER = os.environ.get("SMTP_SERVER", "smtp.gmail.com")
@@ -79,6 +174,10 @@ class Produto(db.Model):
     categoria_produtos = db.Column(db.String(100))
     subcategoria = db.Column(db.String(100)) 
     valor_unitario = db.Column(db.Numeric(10, 2), nullable=True)
+    # Índice parcial da lista de estoque baixo: só guarda as linhas abaixo do mínimo
+    __table_args__ = (db.Index('ix_produtos_estoque_baixo', 'quantidade', 'estoque_minimo',
+                               postgresql_where=text('quantidade < estoque_minimo'),
+                               sqlite_where=text('quantidade < estoque_minimo')),)
 
 class Amostra(db.Model):
     __tablename__ = 'amostras'
@@ -144,9 +243,131 @@ class Protocolo(db.Model):
     arquivo_pdf = db.Column(db.String(255))
     data_criacao = db.Column(db.DateTime, default=datetime.now)
     data_prevista_devolucao = db.Column(db.DateTime)
+    autentique_documento_id = db.Column(db.String(100))
+
+# Protocolos encerrados: nada mais volta do cliente
+STATUS_PROTOCOLO_ENCERRADO = ('CONCLUIDO', 'DEVOLVIDO')
+
+class ProtocoloItem(db.Model):
+    # Linhas do protocolo normalizadas (espelham itens_json) para consultas em SQL
+    __tablename__ = 'protocolo_itens'
+    id = db.Column(db.Integer, primary_key=True)
+    protocolo_id = db.Column(db.Integer, db.ForeignKey('protocolos.id'), nullable=False, index=True)
+    produto_id = db.Column(db.Integer, db.ForeignKey('produtos.id'), nullable=True)
+    amostra_id = db.Column(db.Integer, db.ForeignKey('amostras.id'), nullable=True)
+    sku = db.Column(db.String(100), index=True)
+    nome = db.Column(db.String(150))
+    quantidade = db.Column(db.Integer, default=1, nullable=False)
+    quantidade_devolvida = db.Column(db.Integer, default=0, nullable=False)
+    preco_unit = db.Column(db.Numeric(10, 2), default=0)
+    subtotal = db.Column(db.Numeric(10, 2), default=0)
+    vendedor_email = db.Column(db.String(150), index=True)
+
+class DadosVersao(db.Model):
+    __tablename__ = 'dados_versao'
+    id = db.Column(db.Integer, primary_key=True)
+    versao = db.Column(db.Integer, default=0, nullable=False)
+
+# --- INICIALIZAÇÃO DO BANCO ---
+# Tabelas, colunas e índices novos são criados pelo comando `flask migrar-banco`
+# (uma vez por deploy, antes de subir os workers; ver Dockerfile)
 
 # --- FUNÇÕES AUXILIARES ---
 
+def versao_dados():
+    return db.session.query(DadosVersao.versao).filter_by(id=1).scalar() or 0
+
+def marcar_dados_alterados(eventos=()):
+    # Chamar antes do commit de qualquer rota que altere estoque/amostras:
+    # invalida o cache e o ETag do dashboard na mesma transação e agenda os
+    # eventos SSE, que só são entregues se o commit acontecer.
+    db.session.query(DadosVersao).filter_by(id=1).update({DadosVersao.versao: DadosVersao.versao + 1})
+    if not eventos: return
+    if db.engine.dialect.name == 'postgresql':
+        # NOTIFY é transacional e o payload tem limite de 8000 bytes: manda em lotes
+        for i in range(0, len(eventos), 20):
+            db.session.execute(text("SELECT pg_notify(:canal, :payload)"),
+                               {'canal': CANAL_EVENTOS, 'payload': json.dumps(eventos[i:i + 20])})
+    else:
+        db.session.info.setdefault('eventos_pendentes', []).extend(eventos)
+
+def evento_item(tipo_item, item, log):
+    # Delta compacto enviado aos dashboards abertos
+    evento = {
+        'tipo_item': tipo_item,
+        'item_id': item.id,
+        'acao': log.acao,
+        'quantidade_log': log.quantidade or 1,
+        'usuario': log.usuario_nome,
+        'data_evento': datetime.now().isoformat(timespec='seconds')
+    }
+    if tipo_item == 'amostra':
+        evento['status'] = item.status
+    else:
+        evento['quantidade'] = item.quantidade
+    return evento
+
+@event.listens_for(db.session, 'after_commit')
+def publicar_eventos_locais(sess):
+    for evento in sess.info.pop('eventos_pendentes', []):
+        distribuir_evento(evento)
+
+@event.listens_for(db.session, 'after_rollback')
+def descartar_eventos_locais(sess):
+    sess.info.pop('eventos_pendentes', None)
+
+def distribuir_evento(evento):
+    for fila in list(_assinantes_eventos):
+        try:
+            fila.put_nowait(evento)
+        except queue.Full:
+            pass
+
+def ouvir_eventos_postgres():
+    # Conexão dedicada (fora do pool) em LISTEN; repassa os NOTIFY às filas locais
+    while True:
+        conexao = None
+        try:
+            if DATABASE_LISTEN_URL:
+                import psycopg2
+                pg = conexao = psycopg2.connect(DATABASE_LISTEN_URL)
+            else:
+                with app.app_context():
+                    conexao = db.engine.raw_connection()
+                conexao.detach()
+                pg = conexao.driver_connection
+            pg.autocommit = True
+            pg.cursor().execute(f"LISTEN {CANAL_EVENTOS}")
+            while True:
+                if select.select([pg], [], [], 60) == ([], [], []): continue
+                pg.poll()
+                while pg.notifies:
+                    for evento in json.loads(pg.notifies.pop(0).payload):
+                        distribuir_evento(evento)
+        except Exception as e:
+            print(f"⚠️ Ouvinte de eventos reiniciando: {e}")
+            if conexao is not None:
+                try: conexao.close()
+                except Exception: pass
+            time.sleep(5)
+
+def worker_assincrono():
+    # SSE mantém a conexão aberta: só é seguro com green threads (worker gevent).
+    # Em worker sync cada dashboard aberto prenderia um processo inteiro.
+    try:
+        from gevent import monkey
+        return monkey.is_module_patched('socket')
+    except ImportError:
+        return False
+
+def iniciar_ouvinte_eventos():
+    global _ouvinte_eventos
+    if db.engine.dialect.name != 'postgresql': return
+    with _lock_ouvinte:
+        if _ouvinte_eventos is None:
+            _ouvinte_eventos = threading.Thread(target=ouvir_eventos_postgres, daemon=True)
+            _ouvinte_eventos.start()
+
 def gerar_pdf_protocolo(protocolo):
     buffer = io.BytesIO()
     doc = SimpleDocTemplate(buffer, pagesize=A4, rightMargin=20, leftMargin=20, topMargin=20, bottomMargin=20)
@@ -337,7 +558,8 @@ def enviar_para_autentique(protocolo, pdf_bytes):
             AUTENTIQUE_URL,
             data={"operations": json.dumps(operations), "map": json.dumps(map_data)},
             files=files,
-            headers=headers
+            headers=headers,
+            timeout=AUTENTIQUE_UPLOAD_TIMEOUT
         )
         resp_json = response.json()
         if "errors" in resp_json:
@@ -346,6 +568,76 @@ def enviar_para_autentique(protocolo, pdf_bytes):
     except Exception as e:
         return {"erro": str(e)}
 
+def consultar_status_autentique(documento_ids):
+    # Consulta vários documentos numa única chamada GraphQL (um alias por documento).
+    # Retorna {documento_id: 'ASSINADO' | 'ASSINATURA_RECUSADA' | None (ainda pendente)}
+    campos = "id signatures { action { name } signed { created_at } rejected { created_at } }"
+    consultas = [f"d{i}: document(id: {json.dumps(doc_id)}) {{ {campos} }}" for i, doc_id in enumerate(documento_ids)]
+    response = requests.post(
+        AUTENTIQUE_URL,
+        json={"query": "query { " + " ".join(consultas) + " }"},
+        headers={"Authorization": f"Bearer {AUTENTIQUE_TOKEN}"},
+        timeout=HTTP_TIMEOUT
+    )
+    data = response.json().get('data') or {}
+
+    resultado = {}
+    for i, doc_id in enumerate(documento_ids):
+        documento = data.get(f"d{i}")
+        if not documento: continue
+        assinaturas = documento.get('signatures') or []
+        # O autor do documento também aparece na lista; só contam os signatários (SIGN)
+        signatarios = [a for a in assinaturas if (a.get('action') or {}).get('name') == 'SIGN'] or assinaturas
+        if any(a.get('rejected') for a in signatarios):
+            resultado[doc_id] = 'ASSINATURA_RECUSADA'
+        elif signatarios and all(a.get('signed') for a in signatarios):
+            resultado[doc_id] = 'ASSINADO'
+        else:
+            resultado[doc_id] = None
+    return resultado
+
+def aplicar_status_assinatura(status_por_documento):
+    # Só move protocolos que ainda aguardam assinatura (não regride devoluções etc.)
+    alterados = 0
+    for novo_status in ('ASSINADO', 'ASSINATURA_RECUSADA'):
+        documentos = [doc_id for doc_id, st in status_por_documento.items() if st == novo_status]
+        if documentos:
+            alterados += Protocolo.query.filter(
+                Protocolo.autentique_documento_id.in_(documentos),
+                Protocolo.status == 'AGUARDANDO_ASSINATURA'
+            ).update({Protocolo.status: novo_status}, synchronize_session=False)
+    db.session.commit()
+    return alterados
+
+def reconciliar_autentique():
+    if not AUTENTIQUE_TOKEN:
+        print("⚠️ Token Autentique não configurado.")
+        return 0
+    pendentes = [doc_id for (doc_id,) in db.session.query(Protocolo.autentique_documento_id).filter(
+        Protocolo.status == 'AGUARDANDO_ASSINATURA', Protocolo.autentique_documento_id.isnot(None))]
+    alterados = 0
+    for i in range(0, len(pendentes), AUTENTIQUE_LOTE):
+        lote = pendentes[i:i + AUTENTIQUE_LOTE]
+        try:
+            alterados += aplicar_status_assinatura(consultar_status_autentique(lote))
+        except Exception as e:
+            db.session.rollback()
+            print(f"❌ Erro ao reconciliar lote Autentique: {e}")
+    return alterados
+
+@app.cli.command('reconciliar-autentique')
+@click.option('--intervalo', default=0, help='Repetir a cada N minutos (0 = executar uma vez).')
+def reconciliar_autentique_cmd(intervalo):
+    """Atualiza o status dos protocolos aguardando assinatura no Autentique."""
+    def executar():
+        print(f"✅ Autentique: {reconciliar_autentique()} protocolos atualizados.")
+    executar()
+    if intervalo:
+        schedule.every(intervalo).minutes.do(executar)
+        while True:
+            schedule.run_pending()
+            time.sleep(30)
+
 def enviar_email_interno(protocolo, pdf_bytes):
     if not SMTP_USER or not SMTP_PASS: return
     try:
@@ -358,7 +650,7 @@ def enviar_email_interno(protocolo, pdf_bytes):
         part = MIMEApplication(pdf_bytes, Name=f"Protocolo_{protocolo.id}.pdf")
         part['Content-Disposition'] = f'attachment; filename="Protocolo_{protocolo.id}.pdf"'
         msg.attach(part)
-        server = smtplib.SMTP(SMTP_SERVER, int(SMTP_PORT))
+        server = smtplib.SMTP(SMTP_SERVER, int(SMTP_PORT), timeout=HTTP_TIMEOUT)
         server.starttls()
         server.login(SMTP_USER, SMTP_PASS)
         server.sendmail(SMTP_USER, [protocolo.vendedor_email, EMAIL_CHEFE], msg.as_string())
@@ -366,6 +658,116 @@ def enviar_email_interno(protocolo, pdf_bytes):
     except Exception as e:
         print(f"❌ Erro ao enviar email interno: {e}")
 
+def encerrar_linhas_amostra(amostra_id):
+    # Amostra voltou, foi vendida ou baixada: nada mais fica pendente nos protocolos
+    ProtocoloItem.query.filter(
+        ProtocoloItem.amostra_id == amostra_id,
+        ProtocoloItem.quantidade_devolvida < ProtocoloItem.quantidade
+    ).update({ProtocoloItem.quantidade_devolvida: ProtocoloItem.quantidade}, synchronize_session=False)
+
+def backfill_protocolo_itens():
+    # Gera as linhas de protocolo_itens a partir do itens_json dos protocolos que
+    # ainda não têm linhas. Produtos/amostras são resolvidos por SKU/nome em memória
+    # (mesma regra do novo_protocolo) para não fazer uma consulta por linha.
+    # A quantidade devolvida é inferida do estado atual:
+    #  - amostra: pendente só se ainda está EM_RUA com o cliente deste protocolo
+    #    (e só no protocolo mais recente desse cliente); senão conta como resolvida;
+    #  - produto: devolvido se o protocolo já está encerrado.
+    amostras_sku, amostras_nome, amostras_situacao = {}, {}, {}
+    for a_id, a_sku, a_nome, a_status, a_cliente in db.session.query(
+            Amostra.id, Amostra.sku_amostras, Amostra.nome, Amostra.status, Amostra.cliente_destino).order_by(Amostra.id.desc()):
+        if a_sku: amostras_sku[a_sku] = a_id
+        if a_nome: amostras_nome[a_nome.lower()] = a_id
+        amostras_situacao[a_id] = (a_status, a_cliente)
+    produtos_sku, produtos_nome = {}, {}
+    for p_id, p_sku, p_nome in db.session.query(Produto.id, Produto.sku_produtos, Produto.nome).filter(Produto.categoria_produtos.ilike('%showroom%')).order_by(Produto.id.desc()):
+        if p_sku: produtos_sku[p_sku] = p_id
+        if p_nome: produtos_nome[p_nome] = p_id
+
+    # Amostras que já têm linha pendente em protocolos migrados não ficam pendentes de novo
+    amostras_na_rua = {a_id for (a_id,) in db.session.query(ProtocoloItem.amostra_id).filter(
+        ProtocoloItem.amostra_id.isnot(None), ProtocoloItem.quantidade_devolvida < ProtocoloItem.quantidade)}
+
+    ja_migrados = db.session.query(ProtocoloItem.protocolo_id).distinct()
+    pendentes = db.session.query(
+        Protocolo.id, Protocolo.vendedor_email, Protocolo.cliente_empresa, Protocolo.status, Protocolo.itens_json
+    ).filter(~Protocolo.id.in_(ja_migrados)).order_by(Protocolo.id.desc()).all()
+
+    linhas = []
+    for p_id, vendedor_email, cliente_empresa, status, itens in pendentes:
+        for item in (itens or []):
+            sku = item.get('sku') or None
+            nome = item.get('nome')
+            quantidade = int(item.get('qtd') or 1)
+            amostra_id = amostras_sku.get(sku) or amostras_nome.get((nome or '').lower())
+            produto_id = None if amostra_id else (produtos_sku.get(sku) or produtos_nome.get(nome))
+            if amostra_id:
+                na_rua = (amostras_situacao[amostra_id] == ('EM_RUA', cliente_empresa)
+                          and amostra_id not in amostras_na_rua)
+                if na_rua: amostras_na_rua.add(amostra_id)
+                devolvida = 0 if na_rua else quantidade
+            else:
+                devolvida = quantidade if status in STATUS_PROTOCOLO_ENCERRADO else 0
+            linhas.append({
+                'protocolo_id': p_id, 'produto_id': produto_id, 'amostra_id': amostra_id,
+                'sku': sku, 'nome': nome, 'quantidade': quantidade, 'quantidade_devolvida': devolvida,
+                'preco_unit': item.get('preco_unit') or 0, 'subtotal': item.get('subtotal') or 0,
+                'vendedor_email': vendedor_email
+            })
+    if linhas:
+        db.session.execute(insert(ProtocoloItem), linhas)
+    db.session.commit()
+    return len(pendentes), len(linhas)
+
+@app.cli.command('backfill-protocolo-itens')
+def backfill_protocolo_itens_cmd():
+    """Popula protocolo_itens a partir do itens_json dos protocolos existentes."""
+    protocolos, linhas = backfill_protocolo_itens()
+    print(f"✅ {protocolos} protocolos migrados ({linhas} linhas).")
+
+def migrar_banco():
+    erros = 0
+    # Tabelas novas (protocolo_itens, dados_versao) e a linha única de versão
+    # dos dados; sem ela o ETag/cache do dashboard não muda dentro do TTL
+    try:
+        db.create_all(bind_key=None)
+        if not db.session.get(DadosVersao, 1):
+            db.session.add(DadosVersao(id=1, versao=0))
+            db.session.commit()
+        print("✅ Tabelas e versão dos dados")
+    except Exception as e:
+        db.session.rollback()
+        erros += 1
+        print(f"❌ Tabelas e versão dos dados: {e}")
+
+    # create_all não altera tabelas existentes. Cada passo roda isolado em
+    # autocommit: no Postgres os índices usam CONCURRENTLY para não bloquear as
+    # escritas (inclusive as do Directus em produtos) enquanto são criados.
+    # Se um CREATE INDEX CONCURRENTLY falhar, o índice fica INVALID: apague-o
+    # (DROP INDEX CONCURRENTLY) e rode o comando de novo.
+    concorrente = 'CONCURRENTLY ' if db.engine.dialect.name == 'postgresql' else ''
+    passos = []
+    if 'autentique_documento_id' not in [c['name'] for c in inspect(db.engine).get_columns('protocolos')]:
+        passos.append("ALTER TABLE protocolos ADD COLUMN autentique_documento_id VARCHAR(100)")
+    passos += [
+        f"CREATE INDEX {concorrente}IF NOT EXISTS ix_protocolos_autentique_documento_id ON protocolos (autentique_documento_id)",
+        f"CREATE INDEX {concorrente}IF NOT EXISTS ix_produtos_estoque_baixo ON produtos (quantidade, estoque_minimo) WHERE quantidade < estoque_minimo",
+    ]
+    with db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conexao:
+        for passo in passos:
+            try:
+                conexao.execute(text(passo))
+                print(f"✅ {passo}")
+            except Exception as e:
+                erros += 1
+                print(f"❌ {passo}: {e}")
+    return erros
+
+@app.cli.command('migrar-banco')
+def migrar_banco_cmd():
+    """Cria tabelas, colunas e índices novos (rodar uma vez por deploy)."""
+    if migrar_banco(): raise SystemExit(1)
+
 # --- ROTAS ---
 
 @app.route('/showroom/', methods=['GET', 'POST'])
@@ -375,13 +777,13 @@ def index():
         password = request.form.get('login_password')
         try:
             if not DIRECTUS_URL: return render_template('index.html', view_mode='login', erro="Sem URL Directus")
-            resp = requests.post(f"{DIRECTUS_URL}/auth/login", json={"email": email, "password": password}, verify=False)
+            resp = requests.post(f"{DIRECTUS_URL}/auth/login", json={"email": email, "password": password}, verify=False, timeout=HTTP_TIMEOUT)
             if resp.status_code == 200:
                 token = resp.json()['data']['access_token']
                 session['user_token'] = token
                 session['user_email'] = email
                 headers = {"Authorization": f"Bearer {token}"}
-                user_info = requests.get(f"{DIRECTUS_URL}/users/me?fields=role.name,first_name,last_name,title", headers=headers, verify=False)
+                user_info = requests.get(f"{DIRECTUS_URL}/users/me?fields=role.name,first_name,last_name,title", headers=headers, verify=False, timeout=HTTP_TIMEOUT)
                 if user_info.status_code == 200:
                     data = user_info.json().get('data', {})
                     role_name = data.get('role', {}).get('name', 'Public') if data.get('role') else 'Public'
@@ -466,11 +868,37 @@ def dashboard():
     filter_cat = request.args.get('cat', '').strip()
     filter_sub = request.args.get('sub', '').strip() 
 
+    hoje = datetime.now().date()
+    chave_cache = (versao_dados(), int(time.time() // DASHBOARD_CACHE_TTL), hoje, search_query, filter_cat, filter_sub)
+    etag = hashlib.md5(repr((chave_cache, session['user_email'], role)).encode()).hexdigest()
+    if request.if_none_match.contains_weak(etag):
+        response = make_response('', 304)
+        response.set_etag(etag, weak=True)
+        return response
+
+    dados = _cache_dashboard.get(chave_cache)
+    if dados is None:
+        dados = montar_dados_dashboard(hoje, search_query, filter_cat, filter_sub)
+        if len(_cache_dashboard) > 200: _cache_dashboard.clear()
+        _cache_dashboard[chave_cache] = dados
+
+    response = make_response(render_template('index.html', view_mode='dashboard', 
+                           listagem_html=dados['listagem_html'],
+                           categorias=dados['categorias'], subcategorias=dados['subcategorias'],
+                           search_query=search_query, selected_cat=filter_cat, selected_sub=filter_sub,
+                           user=session['user_email'], role=role,
+                           total_estoque=dados['total_estoque'], valor_estoque=dados['valor_estoque'], 
+                           ticket_medio=dados['ticket_medio'], mov_hoje=dados['mov_hoje'],
+                           sse_habilitado=worker_assincrono()))
+    response.set_etag(etag, weak=True)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+def montar_dados_dashboard(hoje, search_query, filter_cat, filter_sub):
     total_estoque = db.session.query(func.sum(Produto.quantidade)).scalar() or 0
     valor_estoque = db.session.query(func.sum(Produto.quantidade * Produto.valor_unitario)).scalar() or 0
     ticket_medio = (valor_estoque / total_estoque) if total_estoque > 0 else 0
     
-    hoje = datetime.now().date()
     movimentacoes_hoje = Log.query.filter(func.date(Log.data_evento) == hoje).count()
 
     produtos_showroom = [] 
@@ -505,13 +933,12 @@ def dashboard():
     
     amostras = query_am.order_by(Amostra.status.desc(), Amostra.nome).all()
     
-    return render_template('index.html', view_mode='dashboard', 
-                           produtos_showroom=produtos_showroom, amostras=amostras, 
-                           categorias=categorias_disponiveis, subcategorias=subcategorias_disponiveis,
-                           search_query=search_query, selected_cat=filter_cat, selected_sub=filter_sub,
-                           user=session['user_email'], role=role,
-                           total_estoque=total_estoque, valor_estoque=valor_estoque, 
-                           ticket_medio=ticket_medio, mov_hoje=movimentacoes_hoje)
+    return {
+        'listagem_html': render_template('dashboard_listagem.html', produtos_showroom=produtos_showroom, amostras=amostras),
+        'categorias': categorias_disponiveis, 'subcategorias': subcategorias_disponiveis,
+        'total_estoque': total_estoque, 'valor_estoque': valor_estoque,
+        'ticket_medio': ticket_medio, 'mov_hoje': movimentacoes_hoje
+    }
 
 @app.route('/showroom/protocolos')
 def listar_protocolos():
@@ -644,6 +1071,7 @@ def novo_protocolo():
                     itens_json=itens_processados
                 )
                 db.session.add(novo)
+                eventos = []
                 
                 for item in itens_processados:
                     sku = item.get('sku')
@@ -654,13 +1082,23 @@ def novo_protocolo():
                     if sku: amostra_db = Amostra.query.filter_by(sku_amostras=sku).first()
                     if not amostra_db and nome: amostra_db = Amostra.query.filter(Amostra.nome.ilike(nome)).first()
                     
+                    linha = ProtocoloItem(
+                        protocolo_id=novo.id, sku=sku or None, nome=nome, quantidade=qtd_saida,
+                        preco_unit=item.get('preco_unit') or 0, subtotal=item.get('subtotal') or 0,
+                        vendedor_email=session['user_email']
+                    )
+                    db.session.add(linha)
+
                     if amostra_db:
+                        linha.amostra_id = amostra_db.id
                         amostra_db.status = 'EM_RUA'
                         amostra_db.vendedor_responsavel = session['user_email']
                         amostra_db.cliente_destino = novo.cliente_empresa
                         amostra_db.data_saida = datetime.now()
                         amostra_db.data_prevista_retorno = data_prevista
-                        db.session.add(Log(tipo_item='amostra', item_id=amostra_db.id, acao='PROTOCOLO_SAIDA', usuario_nome=session['user_email']))
+                        log = Log(tipo_item='amostra', item_id=amostra_db.id, acao='PROTOCOLO_SAIDA', usuario_nome=session['user_email'])
+                        db.session.add(log)
+                        eventos.append(evento_item('amostra', amostra_db, log))
                     
                     else:
                         prod_db = Produto.query.filter(
@@ -668,13 +1106,17 @@ def novo_protocolo():
                             Produto.categoria_produtos.ilike('%showroom%')
                         ).first()
                         if prod_db:
+                            linha.produto_id = prod_db.id
                             prod_db.quantidade -= qtd_saida
-                            db.session.add(Log(
+                            log = Log(
                                 tipo_item='produto_showroom', item_id=prod_db.id, 
                                 acao='SAIDA_PROTOCOLO', quantidade=qtd_saida,
                                 usuario_nome=session['user_email']
-                            ))
+                            )
+                            db.session.add(log)
+                            eventos.append(evento_item('produto_showroom', prod_db, log))
 
+                marcar_dados_alterados(eventos)
                 db.session.commit()
                 return redirect(f'/showroom/protocolo/detalhe/{novo.id}')
                 
@@ -706,6 +1148,7 @@ def detalhe_protocolo(id):
             if resultado.get('sucesso'):
                 msg = "✅ Documento enviado para o cliente via Autentique com sucesso!"
                 protocolo.status = 'AGUARDANDO_ASSINATURA'
+                protocolo.autentique_documento_id = resultado['data'].get('id')
                 db.session.commit()
                 enviar_email_interno(protocolo, pdf_bytes)
             else:
@@ -713,6 +1156,111 @@ def detalhe_protocolo(id):
 
     return render_template('index.html', view_mode='detalhe_protocolo', p=protocolo, msg=msg, erro=erro, user=session['user_email'])
 
+@app.route('/showroom/protocolo/devolucao/<int:id>', methods=['GET', 'POST'])
+def devolucao_protocolo(id):
+    # Check-in do protocolo inteiro (ou parcial) numa única transação
+    if 'user_email' not in session: return redirect('/showroom/')
+    protocolo = Protocolo.query.get_or_404(id)
+    msg = None
+    erro = None
+
+    if request.method == 'POST':
+        linhas = ProtocoloItem.query.filter_by(protocolo_id=id).order_by(ProtocoloItem.id).with_for_update().all()
+
+        # Só volta ao estoque a amostra que ainda está na rua com o cliente deste
+        # protocolo (não a vendida/baixada nem a que já saiu em outro protocolo)
+        ids_amostras = [l.amostra_id for l in linhas if l.amostra_id]
+        amostras_na_rua = {a_id for (a_id,) in db.session.query(Amostra.id).filter(
+            Amostra.id.in_(ids_amostras),
+            Amostra.status == 'EM_RUA',
+            Amostra.cliente_destino == protocolo.cliente_empresa
+        ).with_for_update()} if ids_amostras else set()
+
+        # Quantidade informada por linha + SKUs lidos em lote pelo leitor de código de barras
+        solicitado = {l.id: request.form.get(f'qtd_{l.id}', 0, type=int) for l in linhas}
+        for sku in request.form.get('skus_lidos', '').split():
+            for l in linhas:
+                if l.sku == sku and solicitado[l.id] < l.quantidade - l.quantidade_devolvida:
+                    solicitado[l.id] += 1
+                    break
+
+        devolvido_linha = {}
+        encerradas = {}
+        amostras_ids = []
+        produtos_qtd = {}
+        logs = []
+        ignorados = []
+        for l in linhas:
+            pendente = l.quantidade - l.quantidade_devolvida
+            if pendente <= 0: continue
+            # Amostra vendida, baixada ou alterada no Directus: a linha é encerrada
+            # (como em encerrar_linhas_amostra) sem mexer na amostra nem no estoque
+            if l.amostra_id and l.amostra_id not in amostras_na_rua:
+                encerradas[l.id] = pendente
+                ignorados.append(l.nome)
+                continue
+            qtd = min(max(solicitado[l.id], 0), pendente)
+            if qtd <= 0: continue
+            devolvido_linha[l.id] = qtd
+            if l.amostra_id:
+                amostras_ids.append(l.amostra_id)
+                logs.append({'tipo_item': 'amostra', 'item_id': l.amostra_id, 'acao': 'PROTOCOLO_DEVOLUCAO',
+                             'quantidade': 1, 'usuario_nome': session['user_email']})
+            elif l.produto_id:
+                produtos_qtd[l.produto_id] = produtos_qtd.get(l.produto_id, 0) + qtd
+                logs.append({'tipo_item': 'produto_showroom', 'item_id': l.produto_id, 'acao': 'DEVOLUCAO_PROTOCOLO',
+                             'quantidade': qtd, 'usuario_nome': session['user_email']})
+
+        if not devolvido_linha and not encerradas:
+            erro = "Nenhum item selecionado para devolução."
+        else:
+            try:
+                baixas = {**devolvido_linha, **encerradas}
+                ProtocoloItem.query.filter(ProtocoloItem.id.in_(list(baixas))).update(
+                    {ProtocoloItem.quantidade_devolvida: ProtocoloItem.quantidade_devolvida + case(baixas, value=ProtocoloItem.id, else_=0)},
+                    synchronize_session=False)
+                if amostras_ids:
+                    Amostra.query.filter(
+                        Amostra.id.in_(amostras_ids),
+                        Amostra.status == 'EM_RUA',
+                        Amostra.cliente_destino == protocolo.cliente_empresa
+                    ).update(
+                        {Amostra.status: 'DISPONIVEL', Amostra.vendedor_responsavel: None, Amostra.cliente_destino: None},
+                        synchronize_session=False)
+                if produtos_qtd:
+                    Produto.query.filter(Produto.id.in_(list(produtos_qtd))).update(
+                        {Produto.quantidade: Produto.quantidade + case(produtos_qtd, value=Produto.id, else_=0)},
+                        synchronize_session=False)
+                if logs:
+                    db.session.execute(insert(Log), logs)
+
+                completo = all(l.quantidade_devolvida + baixas.get(l.id, 0) >= l.quantidade for l in linhas)
+                protocolo.status = 'DEVOLVIDO' if completo else 'DEVOLUCAO_PARCIAL'
+
+                # Deltas SSE com os valores já atualizados (uma consulta por tipo)
+                agora = datetime.now().isoformat(timespec='seconds')
+                eventos = [{'tipo_item': 'amostra', 'item_id': a_id, 'acao': 'PROTOCOLO_DEVOLUCAO', 'quantidade_log': 1,
+                            'usuario': session['user_email'], 'data_evento': agora, 'status': 'DISPONIVEL'}
+                           for a_id in amostras_ids]
+                if produtos_qtd:
+                    for p_id, qtd_atual in db.session.query(Produto.id, Produto.quantidade).filter(Produto.id.in_(list(produtos_qtd))):
+                        eventos.append({'tipo_item': 'produto_showroom', 'item_id': p_id, 'acao': 'DEVOLUCAO_PROTOCOLO',
+                                        'quantidade_log': produtos_qtd[p_id], 'usuario': session['user_email'],
+                                        'data_evento': agora, 'quantidade': qtd_atual})
+                marcar_dados_alterados(eventos)
+                db.session.commit()
+                msg = f"{sum(devolvido_linha.values())} item(ns) devolvido(s). Protocolo {'concluído' if completo else 'com devolução parcial'}."
+                if ignorados: msg += f" Encerradas sem voltar ao estoque (não estão mais com este cliente): {', '.join(ignorados)}."
+            except Exception as e:
+                db.session.rollback()
+                print(f"Erro na devolução do protocolo: {traceback.format_exc()}")
+                erro = f"Erro ao registrar devolução: {e}"
+
+    linhas = ProtocoloItem.query.filter_by(protocolo_id=id).order_by(ProtocoloItem.id).all()
+    if not linhas and protocolo.itens_json and not erro:
+        erro = "Protocolo anterior à tabela de itens: rode 'flask backfill-protocolo-itens' antes da devolução."
+    return render_template('index.html', view_mode='devolucao_protocolo', p=protocolo, linhas=linhas, msg=msg, erro=erro, user=session['user_email'])
+
 @app.route('/showroom/protocolo/download/<int:id>')
 def download_protocolo(id):
     if 'user_email' not in session: return redirect('/showroom/')
@@ -747,10 +1295,12 @@ def acao(tipo, id):
                     if item.quantidade > 0:
                         item.quantidade -= 1
                         acao_log = 'WEB_BAIXA_VENDIDO' if acao_realizada == 'vendido' else 'WEB_BAIXA_FORA_LINHA'
-                        db.session.add(Log(
+                        log = Log(
                             tipo_item='produto_showroom', item_id=item.id, 
                             acao=acao_log, quantidade=1, usuario_nome=session['user_email']
-                        ))
+                        )
+                        db.session.add(log)
+                        marcar_dados_alterados([evento_item('produto_showroom', item, log)])
                         db.session.commit()
                         msg_sucesso = "1 Unidade baixada do estoque de Showroom."
                     else:
@@ -763,24 +1313,201 @@ def acao(tipo, id):
         item = Amostra.query.get_or_404(id)
         if request.method == 'POST':
             acao_realizada = request.form.get('acao_amostra')
+            log = None
             if acao_realizada == 'devolver':
                 item.status = 'DISPONIVEL'
                 item.vendedor_responsavel = None
                 item.cliente_destino = None
-                db.session.add(Log(tipo_item='amostra', item_id=item.id, acao='WEB_DEVOLUCAO', usuario_nome=session['user_email']))
+                log = Log(tipo_item='amostra', item_id=item.id, acao='WEB_DEVOLUCAO', usuario_nome=session['user_email'])
+                encerrar_linhas_amostra(item.id)
             elif acao_realizada == 'vendido':
                 item.status = 'VENDIDO'
                 item.vendedor_responsavel = session['user_email'] 
-                db.session.add(Log(tipo_item='amostra', item_id=item.id, acao='WEB_VENDIDO', usuario_nome=session['user_email']))
+                log = Log(tipo_item='amostra', item_id=item.id, acao='WEB_VENDIDO', usuario_nome=session['user_email'])
+                encerrar_linhas_amostra(item.id)
             elif acao_realizada == 'fora_linha':
                 item.status = 'FORA_DE_LINHA'
-                db.session.add(Log(tipo_item='amostra', item_id=item.id, acao='WEB_BAIXA', usuario_nome=session['user_email']))
+                log = Log(tipo_item='amostra', item_id=item.id, acao='WEB_BAIXA', usuario_nome=session['user_email'])
+                encerrar_linhas_amostra(item.id)
             
+            if log:
+                db.session.add(log)
+                marcar_dados_alterados([evento_item('amostra', item, log)])
             db.session.commit()
             msg_sucesso = "Status atualizado com sucesso!"
 
     return render_template('index.html', view_mode='acao', item=item, tipo=tipo, msg=msg_sucesso)
 
+# --- WEBHOOK AUTENTIQUE ---
+def documento_do_evento(dados):
+    # Eventos de assinatura trazem data.document (id ou objeto com id);
+    # eventos de documento trazem o próprio documento em data (object == 'document')
+    documento = dados.get('document')
+    if isinstance(documento, dict): documento = documento.get('id')
+    if not documento and dados.get('object') == 'document': documento = dados.get('id')
+    return documento if isinstance(documento, str) and documento else None
+
+@app.route('/showroom/webhooks/autentique', methods=['POST'])
+def webhook_autentique():
+    if not AUTENTIQUE_WEBHOOK_SECRET: return jsonify({'erro': 'Webhook não configurado'}), 503
+    assinatura = request.headers.get('X-Autentique-Signature', '')
+    esperado = hmac.new(AUTENTIQUE_WEBHOOK_SECRET.encode(), request.get_data(), hashlib.sha256).hexdigest()
+    if not hmac.compare_digest(assinatura, esperado): return jsonify({'erro': 'Assinatura inválida'}), 401
+
+    payload = request.get_json(silent=True)
+    if not isinstance(payload, dict): return jsonify({'ok': True, 'ignorado': True})
+    evento = payload.get('event') if isinstance(payload.get('event'), dict) else payload
+    tipo = evento.get('type') or ''
+    dados = evento.get('data') if isinstance(evento.get('data'), dict) else {}
+    doc_id = documento_do_evento(dados)
+    if not doc_id: return jsonify({'ok': True, 'ignorado': True})
+
+    if tipo in ('signature.accepted', 'document.finished'):
+        novo_status = 'ASSINADO'
+    elif tipo == 'signature.rejected':
+        novo_status = 'ASSINATURA_RECUSADA'
+    else:
+        return jsonify({'ok': True, 'ignorado': True})
+    return jsonify({'ok': True, 'atualizados': aplicar_status_assinatura({doc_id: novo_status})})
+
+# --- ANALYTICS (protocolo_itens) ---
+# Administrador vê todos os vendedores; os demais só os próprios protocolos.
+# Aplicar antes de group_by/order_by/limit (Query.filter não aceita depois do LIMIT).
+def filtrar_vendedor(query):
+    if session.get('user_role', 'PUBLIC') != 'ADMINISTRATOR':
+        query = query.filter(ProtocoloItem.vendedor_email == session['user_email'])
+    return query
+
+@app.route('/showroom/api/analytics/skus_mais_saidas')
+def analytics_skus_mais_saidas():
+    if 'user_email' not in session: return jsonify({'erro': 'Acesso negado'}), 403
+    limite = min(max(request.args.get('limite', 20, type=int), 1), 500)
+    total_qtd = func.sum(ProtocoloItem.quantidade)
+    query = filtrar_vendedor(db.session.query(
+        ProtocoloItem.sku, func.max(ProtocoloItem.nome),
+        total_qtd, func.count(func.distinct(ProtocoloItem.protocolo_id))
+    )).group_by(ProtocoloItem.sku).order_by(total_qtd.desc()).limit(limite)
+    return jsonify([
+        {'sku': sku, 'nome': nome, 'quantidade': int(qtd or 0), 'protocolos': protocolos}
+        for sku, nome, qtd, protocolos in query.all()
+    ])
+
+@app.route('/showroom/api/analytics/valor_na_rua')
+def analytics_valor_na_rua():
+    if 'user_email' not in session: return jsonify({'erro': 'Acesso negado'}), 403
+    qtd_pendente = ProtocoloItem.quantidade - ProtocoloItem.quantidade_devolvida
+    query = filtrar_vendedor(db.session.query(
+        ProtocoloItem.vendedor_email, func.sum(qtd_pendente), func.sum(qtd_pendente * ProtocoloItem.preco_unit)
+    ).filter(qtd_pendente > 0)).group_by(ProtocoloItem.vendedor_email).order_by(ProtocoloItem.vendedor_email)
+    return jsonify([
+        {'vendedor_email': vendedor, 'quantidade': int(qtd or 0), 'valor': float(valor or 0)}
+        for vendedor, qtd, valor in query.all()
+    ])
+
+@app.route('/showroom/api/analytics/itens_pendentes')
+def analytics_itens_pendentes():
+    if 'user_email' not in session: return jsonify({'erro': 'Acesso negado'}), 403
+    qtd_pendente = ProtocoloItem.quantidade - ProtocoloItem.quantidade_devolvida
+    query = filtrar_vendedor(db.session.query(
+        ProtocoloItem.protocolo_id, ProtocoloItem.sku, ProtocoloItem.nome, qtd_pendente,
+        ProtocoloItem.vendedor_email, Protocolo.cliente_empresa, Protocolo.data_prevista_devolucao
+    ).join(Protocolo, Protocolo.id == ProtocoloItem.protocolo_id).filter(qtd_pendente > 0)).order_by(Protocolo.data_prevista_devolucao, ProtocoloItem.protocolo_id)
+    return jsonify([
+        {'protocolo_id': p_id, 'sku': sku, 'nome': nome, 'quantidade_pendente': qtd,
+         'vendedor_email': vendedor, 'cliente_empresa': empresa,
+         'data_prevista_devolucao': data.strftime('%Y-%m-%d') if data else None}
+        for p_id, sku, nome, qtd, vendedor, empresa, data in query.all()
+    ])
+
+# --- RELATÓRIO DE ESTOQUE ---
+def agregar_estoque():
+    # Quantidade, valor e itens abaixo do mínimo por local, categoria e
+    # categoria/subcategoria, mais o total geral. No Postgres é uma única
+    # passada com GROUPING SETS; nos demais bancos, um GROUP BY por conjunto.
+    niveis = [
+        ('localizacao', [Produto.localizacao]),
+        ('categoria', [Produto.categoria_produtos]),
+        ('subcategoria', [Produto.categoria_produtos, Produto.subcategoria]),
+        ('total', []),
+    ]
+    colunas = [Produto.localizacao, Produto.categoria_produtos, Produto.subcategoria]
+    metricas = [
+        func.coalesce(func.sum(Produto.quantidade), 0),
+        func.coalesce(func.sum(Produto.quantidade * Produto.valor_unitario), 0),
+        func.sum(case((Produto.quantidade < Produto.estoque_minimo, 1), else_=0)),
+    ]
+
+    if db.engine.dialect.name == 'postgresql':
+        # grouping() devolve um bitmask (1 = coluna fora do conjunto) que identifica o nível
+        mascara = {0b011: 'localizacao', 0b101: 'categoria', 0b100: 'subcategoria', 0b111: 'total'}
+        linhas = db.session.query(func.grouping(*colunas), *colunas, *metricas).group_by(
+            func.grouping_sets(*[tuple_(*cols) if cols else text('()') for _, cols in niveis])
+        ).all()
+        resultado = [(mascara[g], *resto) for g, *resto in linhas]
+    else:
+        resultado = []
+        for nivel, cols in niveis:
+            selecionadas = [c if c in cols else literal(None).label(c.key) for c in colunas]
+            query = db.session.query(*selecionadas, *metricas)
+            if cols: query = query.group_by(*cols)
+            resultado += [(nivel, *linha) for linha in query.all()]
+
+    return [
+        {'nivel': nivel, 'localizacao': local, 'categoria': categoria, 'subcategoria': subcategoria,
+         'quantidade': int(qtd or 0), 'valor': float(valor or 0), 'abaixo_minimo': int(abaixo or 0)}
+        for nivel, local, categoria, subcategoria, qtd, valor, abaixo in resultado
+    ]
+
+@app.route('/showroom/api/relatorio_estoque')
+def relatorio_estoque():
+    if 'user_email' not in session: return jsonify({'erro': 'Acesso negado'}), 403
+    limite = min(max(request.args.get('limite', 100, type=int), 1), 500)
+    chave_cache = (versao_dados(), int(time.time() // DASHBOARD_CACHE_TTL), limite)
+    dados = _cache_relatorio.get(chave_cache)
+    if dados is None:
+        # O filtro é o mesmo predicado do índice parcial ix_produtos_estoque_baixo,
+        # que só contém produtos abaixo do mínimo, já ordenados por (quantidade, estoque_minimo)
+        estoque_baixo = db.session.query(
+            Produto.id, Produto.nome, Produto.sku_produtos, Produto.localizacao, Produto.quantidade, Produto.estoque_minimo
+        ).filter(Produto.quantidade < Produto.estoque_minimo).order_by(Produto.quantidade, Produto.estoque_minimo).limit(limite).all()
+        dados = {
+            'grupos': agregar_estoque(),
+            'estoque_baixo': [
+                {'id': p_id, 'nome': nome, 'sku': sku, 'localizacao': local, 'quantidade': qtd, 'estoque_minimo': minimo}
+                for p_id, nome, sku, local, qtd, minimo in estoque_baixo
+            ]
+        }
+        if len(_cache_relatorio) > 50: _cache_relatorio.clear()
+        _cache_relatorio[chave_cache] = dados
+    return jsonify(dados)
+
+# --- EVENTOS EM TEMPO REAL (SSE) ---
+# Cada conexão fica aberta indefinidamente: exige o worker gevent (gunicorn.conf.py)
+@app.route('/showroom/api/eventos')
+def stream_eventos():
+    if 'user_email' not in session: return jsonify({'erro': 'Acesso negado'}), 403
+    # 204 faz o EventSource parar de reconectar
+    if not worker_assincrono(): return '', 204
+    iniciar_ouvinte_eventos()
+    fila = queue.Queue(maxsize=200)
+    _assinantes_eventos.add(fila)
+
+    def gerar():
+        try:
+            yield "retry: 5000\n\n"
+            while True:
+                try:
+                    evento = fila.get(timeout=25)
+                    yield f"data: {json.dumps(evento)}\n\n"
+                except queue.Empty:
+                    # Mantém a conexão viva em proxies
+                    yield ": ping\n\n"
+        finally:
+            _assinantes_eventos.discard(fila)
+
+    return Response(gerar(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
 @app.route('/showroom/perfil/senha', methods=['GET', 'POST'])
 def alterar_senha():
     if 'user_email' not in session: return redirect('/showroom/')
@@ -803,7 +1530,7 @@ def alterar_senha():
                 }
                 payload = {"password": nova_senha}
                 
-                resp = requests.patch(f"{DIRECTUS_URL}/users/me", json=payload, headers=headers)
+                resp = requests.patch(f"{DIRECTUS_URL}/users/me", json=payload, headers=headers, timeout=HTTP_TIMEOUT)
 
                 if resp.status_code == 200:
                     msg = "Senha alterada com sucesso!"
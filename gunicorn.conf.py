@@ -0,0 +1,40 @@
+# --- CONFIGURAÇÃO GUNICORN ---
+# Quase todas as rotas lentas do app.py ficam esperando chamadas externas
+# (login Directus, CNPJ.ws, upload Autentique, SMTP). Com workers "sync" cada
+# chamada lenta trava um processo inteiro; com "gevent" cada worker atende
+# várias requisições em green threads enquanto as outras aguardam I/O.
+#
+# Variáveis de ambiente:
+#   GUNICORN_WORKER_CLASS   gevent (padrão) | sync (desliga o SSE do dashboard)
+#   GUNICORN_WORKERS        nº de processos (padrão 4)
+#   GUNICORN_CONNECTIONS    requisições simultâneas por worker gevent (padrão 100)
+#   GUNICORN_TIMEOUT        timeout do worker em segundos (padrão 120)
+#
+# Dimensionamento do pool de conexões (ver DB_POOL_SIZE / DB_MAX_OVERFLOW no app.py):
+#   Cada worker tem seu próprio pool SQLAlchemy. O total de conexões abertas no
+#   Postgres pode chegar a  GUNICORN_WORKERS * (DB_POOL_SIZE + DB_MAX_OVERFLOW)
+#   e deve ficar abaixo do max_connections do banco (deixe folga p/ Directus).
+#   Ex.: 4 workers * (10 + 10) = 80 conexões no pico.
+#   GUNICORN_CONNECTIONS pode (e deve) ser bem maior que o pool: as green threads
+#   passam a maior parte do tempo esperando APIs externas, não o banco. Quando o
+#   pool esgota, a requisição aguarda até DB_POOL_TIMEOUT segundos por uma conexão.
+#   Com DATABASE_REPLICA_URL o worker mantém um segundo pool (DB_REPLICA_*), que
+#   conta no max_connections da réplica.
+#   Com DB_PGBOUNCER=1 não há pool local (NullPool): o limite passa a ser o
+#   default_pool_size do PgBouncer; cada worker com dashboards abertos ainda usa
+#   1 conexão direta para o LISTEN dos eventos (DATABASE_LISTEN_URL).
+import os
+
+bind = "0.0.0.0:5000"
+worker_class = os.environ.get("GUNICORN_WORKER_CLASS", "gevent")
+workers = int(os.environ.get("GUNICORN_WORKERS", 4))
+worker_connections = int(os.environ.get("GUNICORN_CONNECTIONS", 100))
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", 120))
+
+
+def post_fork(server, worker):
+    # O psycopg2 é uma extensão C: sem o psycogreen uma query bloqueia o worker
+    # inteiro em vez de só a green thread atual.
+    if worker_class == "gevent":
+        from psycogreen.gevent import patch_psycopg
+        patch_psycopg()
@@ -0,0 +1,43 @@
+# Simula a API GraphQL do Autentique para testar `flask reconciliar-autentique`.
+# Responde às consultas em lote com aliases (d0: document(id: "...") { ... }).
+# O status sai do id do documento:
+#   assinado...  -> signatário assinou       recusado...  -> signatário recusou
+#   outros ids   -> ainda pendente           inexistente... -> documento não encontrado
+#
+#   python scripts/autentique_stub.py 9912 &
+#   AUTENTIQUE_URL=http://127.0.0.1:9912/ AUTENTIQUE_TOKEN=teste flask --app app reconciliar-autentique
+import sys
+import json
+import re
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+PORTA = int(sys.argv[1]) if len(sys.argv) > 1 else 9912
+CONSULTA_DOCUMENTO = re.compile(r'(\w+)\s*:\s*document\(\s*id\s*:\s*"([^"]*)"\s*\)')
+
+def documento(doc_id):
+    if doc_id.startswith('inexistente'): return None
+    signatario = {'action': {'name': 'SIGN'}, 'signed': None, 'rejected': None}
+    if doc_id.startswith('assinado'): signatario['signed'] = {'created_at': '2026-01-01 12:00:00'}
+    if doc_id.startswith('recusado'): signatario['rejected'] = {'created_at': '2026-01-01 12:00:00'}
+    # O autor do documento também aparece nas assinaturas, já assinado
+    autor = {'action': None, 'signed': {'created_at': '2026-01-01 11:00:00'}, 'rejected': None}
+    return {'id': doc_id, 'signatures': [autor, signatario]}
+
+class AutentiqueStub(BaseHTTPRequestHandler):
+    def do_POST(self):
+        corpo = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        consultas = CONSULTA_DOCUMENTO.findall(corpo.get('query', ''))
+        print(f"Consulta com {len(consultas)} documento(s)")
+        resposta = json.dumps({'data': {alias: documento(doc_id) for alias, doc_id in consultas}}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(resposta)))
+        self.end_headers()
+        self.wfile.write(resposta)
+
+    def log_message(self, *args):
+        pass
+
+if __name__ == '__main__':
+    print(f"Stub do Autentique em http://127.0.0.1:{PORTA}")
+    ThreadingHTTPServer(('127.0.0.1', PORTA), AutentiqueStub).serve_forever()
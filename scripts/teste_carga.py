@@ -0,0 +1,27 @@
+# Teste de carga do login com upstream lento: compara workers sync x gevent.
+#
+#   python scripts/upstream_lento.py 9911 2 &
+#   DATABASE_URL=sqlite:// DIRECTUS_URL=http://127.0.0.1:9911 GUNICORN_WORKERS=1 \
+#       GUNICORN_WORKER_CLASS=sync gunicorn -c gunicorn.conf.py -b 127.0.0.1:5000 app:app &
+#   python scripts/teste_carga.py http://127.0.0.1:5000 20
+#   (repetir com GUNICORN_WORKER_CLASS=gevent)
+#
+# Com 1 worker e atraso de 2s: sync ~40s (serializado), gevent ~2-3s.
+import sys
+import time
+import concurrent.futures
+import requests
+
+URL = sys.argv[1] if len(sys.argv) > 1 else 'http://127.0.0.1:5000'
+REQUISICOES = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+
+def login(_):
+    resp = requests.post(f"{URL}/showroom/", data={'login_email': 'carga@teste', 'login_password': 'x'}, timeout=300)
+    return resp.status_code
+
+if __name__ == '__main__':
+    inicio = time.time()
+    with concurrent.futures.ThreadPoolExecutor(REQUISICOES) as executor:
+        status = list(executor.map(login, range(REQUISICOES)))
+    duracao = time.time() - inicio
+    print(f"{status.count(200)}/{REQUISICOES} respostas 200 em {duracao:.1f}s ({REQUISICOES / duracao:.1f} req/s)")
@@ -0,0 +1,21 @@
+# Simula um Directus lento para o teste de carga (scripts/teste_carga.py).
+# Uso: python scripts/upstream_lento.py [porta] [atraso_segundos]
+import sys
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+PORTA = int(sys.argv[1]) if len(sys.argv) > 1 else 9911
+ATRASO = float(sys.argv[2]) if len(sys.argv) > 2 else 2.0
+
+class UpstreamLento(BaseHTTPRequestHandler):
+    def do_POST(self):
+        time.sleep(ATRASO)
+        self.send_response(401)
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+if __name__ == '__main__':
+    print(f"Upstream lento em http://127.0.0.1:{PORTA} (atraso {ATRASO}s)")
+    ThreadingHTTPServer(('127.0.0.1', PORTA), UpstreamLento).serve_forever()